@@ -85,13 +85,16 @@ else:
 # - REMOTE : Remote repository url
 # - PATH : Where the meta repository is cloned (if development is local)
 # - DEPLOYMENT : mode of deployment (local, sidecar)
+# - REFRESH : seconds between background pulls, to catch missed webhooks
+#             (0 disables them)
 META = {
     'REMOTE': env('META_REPO'),
     'ELECDIR': env('ELECTION_DIR'),
     'PATH': env('META_PATH', 'meta'),
     'DEPLOYMENT': env('META_DEPLOYMENT', 'local'),
     'BRANCH': env('META_BRANCH', 'main'),
-    'SECRET': env('META_SECRET')
+    'SECRET': env('META_SECRET'),
+    'REFRESH': int(env('META_REFRESH', 300))
 }
 
 # Third Party Integrations
@@ -42,6 +42,9 @@ def before_request():
     # Set Session
     utils.set_session(APP)
 
+    # Keep the meta repository in sync in the background
+    meta.refresher.start()
+
 
 @APP.teardown_appcontext
 def destroy_session(exception=None):
@@ -14,11 +14,10 @@
 #
 # Author(s):         Manish Sahani <rec.manish.sahani@gmail.com>
 
-import os
+import flask as F
 
-from elekto import APP, SESSION, csrf
+from elekto import APP, csrf
 from elekto.models import meta
-from elekto.models.utils import sync
 from elekto.middlewares.webhook import webhook_guard
 
 
@@ -26,9 +25,37 @@ from elekto.middlewares.webhook import webhook_guard
 @webhook_guard
 @csrf.exempt
 def webhook_sync():
-    backend = meta.Meta(APP.config['META'])
-    if not os.path.exists(backend.META) or not os.path.isdir(backend.META):
-        backend.clone()
-    else:
-        backend.pull()
-    return sync(SESSION, meta.Election.all())
+    # git and the sync run in the background, only rebuild the elections
+    # touched by the push
+    meta.refresher.submit(changed_paths(F.request.get_json(silent=True),
+                                        APP.config['META']['BRANCH']))
+    return 'Sync queued', 202
+
+
+def changed_paths(payload, branch):
+    """
+    List the files added, modified or removed by a github push event.
+
+    Args:
+        payload (dict): json body of the webhook request
+        branch (string): branch of the meta repository the application reads
+
+    Returns:
+        list: changed paths, or None if the payload is not a (complete) push
+    """
+    if not isinstance(payload, dict):
+        return None
+    # a force push only lists the new commits, the files of the dropped ones
+    # are unknown, and a push to another branch says nothing about ours
+    if payload.get('forced') or payload.get('ref') != 'refs/heads/{}'.format(branch):
+        return None
+
+    commits = payload.get('commits')
+    # github lists at most 20 commits in a push event, larger pushes (and
+    # other events like ping) need a full sync
+    if not commits or len(commits) >= 20:
+        return None
+
+    return [path for commit in commits
+            for change in ('added', 'modified', 'removed')
+            for path in commit.get(change, [])]
@@ -49,9 +49,8 @@ def voter_guard(f):
             return F.abort(404)
 
         election = meta.Election(kwargs['eid'])
-        voters = election.voters()
 
-        if F.g.user.username not in voters['eligible_voters']:
+        if not election.eligible(F.g.user.username):
             return F.render_template('errors/not_eligible.html',
                                      election=election.get())
         return f(*args, **kwargs)
@@ -69,13 +68,12 @@ def exception_guard(f):
             return F.abort(404)
 
         election = meta.Election(kwargs['eid'])
-        voters = election.voters()
 
         if election.get()['exception_due'] < datetime.now():
             F.flash('Not accepting any exception request.')
             return F.redirect(F.url_for('elections_single', eid=kwargs['eid']))
 
-        if F.g.user.username in voters['eligible_voters']:
+        if election.eligible(F.g.user.username):
             F.flash('You are already eligible to vote in the election.')
             return F.redirect(F.url_for('elections_single', eid=kwargs['eid']))
 
@@ -15,13 +15,21 @@
 # Author(s):         Manish Sahani <rec.manish.sahani@gmail.com>
 
 import os
+import fcntl
+import queue
+import functools
+import pickle
 import random
+import threading
+import time
+import tempfile
 import subprocess
 import flask as F
 
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
-from elekto import APP, constants
+from elekto import APP, SESSION, constants
 from elekto.models import utils
 
 
@@ -32,6 +40,12 @@ class Meta:
     and provides the utils to read data (YAML) files.
     """
 
+    # seconds a swapped out worktree is kept for the requests still reading it
+    GRACE = 600
+    # bump whenever the elections built by Election change, the elections
+    # saved by older releases are then parsed again
+    CACHE_FORMAT = 1
+
     def __init__(self, config):
         self.META = os.path.abspath(config['PATH'])
         self.ELECDIR = config['ELECDIR']
@@ -39,12 +53,161 @@ class Meta:
         self.BRANCH = config['BRANCH']
         self.SECRET = config['SECRET']
         self.git = '/usr/bin/git'
+        # bare mirror of the remote, the META path links to a worktree of it
+        self.mirror = self.META + '.git'
+        # parsed elections of a commit, shared by the workers and restarts
+        self.cache = self.META + '.cache.pickle'
 
     def clone(self):
-        subprocess.run([self.git, 'clone', '-b', self.BRANCH, '--', self.REMOTE, self.META], check=True)
+        # the link to the worktree may be gone while the mirror is still there
+        if os.path.isdir(self.mirror):
+            return self.checkout(self.tip())
+
+        # only the tip of the branch is ever read, skip the history
+        subprocess.run([self.git, 'clone', '--bare', '--depth=1', '--single-branch', '-b', self.BRANCH, '--', self.REMOTE, self.mirror], check=True)
+        self.checkout(self.tip())
+
+    def head(self, path=None):
+        """Return the sha of the commit checked out in the meta repository"""
+        return subprocess.run([self.git, '-C', path or self.META, 'rev-parse', 'HEAD'],
+                              check=True, capture_output=True, text=True).stdout.strip()
+
+    def tip(self):
+        """Return the sha of the branch in the bare mirror"""
+        return subprocess.run([self.git, '-C', self.mirror, 'rev-parse', 'refs/heads/{}'.format(self.BRANCH)],
+                              check=True, capture_output=True, text=True).stdout.strip()
+
+    def version(self):
+        """
+        Return a value that changes whenever the checked out meta repository
+        changes, None if that can't be told without reading every file
+        """
+        if os.path.islink(self.META):
+            # every commit is checked out in its own worktree
+            return os.path.realpath(self.META)
+        try:
+            return os.stat(os.path.join(self.META, '.git', 'index')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """
+        Return the elections saved for the checked out commit
+
+        Returns:
+            list: the elections, None if none were saved for the commit
+        """
+        try:
+            with open(self.cache, 'rb') as f:
+                key, elections = pickle.load(f)
+            return elections if key == self.cachekey(self.head()) else None
+        except Exception:
+            return None
+
+    def save(self, sha, elections):
+        """
+        Save the elections parsed from the commit, the file is replaced
+        atomically so a reader never loads a partial one
+
+        Args:
+            sha (string): commit the elections were parsed from
+            elections (list): parsed elections
+        """
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.cache))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump((self.cachekey(sha), elections), f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, self.cache)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError:
+            APP.logger.exception('Saving the parsed elections failed')
+
+    def cachekey(self, sha):
+        """
+        Return what the saved elections depend on besides their files: the
+        commit, the elections directory and the format of built elections
+        """
+        return (sha, self.ELECDIR, Meta.CACHE_FORMAT)
+
+    def remote_head(self):
+        """Return the sha of the branch's tip on the remote"""
+        out = subprocess.run([self.git, '-C', self.META, 'ls-remote', 'origin', 'refs/heads/{}'.format(self.BRANCH)],
+                             check=True, capture_output=True, text=True).stdout.split()
+        return out[0] if out else None
 
     def pull(self):
-        subprocess.run([self.git, '--git-dir', '{}/.git'.format(self.META),'--work-tree', self.META, 'pull', '--ff-only', 'origin', self.BRANCH], check=True)
+        """
+        Update the meta repository to the remote branch, the fetch is skipped
+        when the remote has nothing new.
+
+        Returns:
+            bool: True if the repository was updated
+        """
+        if self.remote_head() == self.head():
+            return False
+
+        if not os.path.islink(self.META):
+            # repository cloned in place (by older releases), pull in place
+            subprocess.run([self.git, '-C', self.META, 'pull', '--ff-only', 'origin', self.BRANCH], check=True)
+            return True
+
+        subprocess.run([self.git, '-C', self.mirror, 'fetch', '--depth=1', 'origin',
+                        '+refs/heads/{0}:refs/heads/{0}'.format(self.BRANCH)], check=True)
+        self.checkout(self.tip())
+        return True
+
+    def checkout(self, sha):
+        """
+        Check the commit out in a new worktree and atomically point the META
+        path to it, readers never see a half updated tree.
+
+        Args:
+            sha (string): commit to check out
+        """
+        tree = '{}@{}'.format(self.META, sha)
+        if not os.path.isdir(tree):
+            subprocess.run([self.git, '-C', self.mirror, 'worktree', 'add', '--detach', tree, sha], check=True)
+
+        previous = os.path.realpath(self.META) if os.path.islink(self.META) else None
+        link = '{}.{}.tmp'.format(self.META, os.getpid())
+        os.symlink(os.path.basename(tree), link)
+        os.replace(link, self.META)
+
+        # stamp the tree that was just swapped out, it is removed once it has
+        # been retired for longer than the grace period
+        if previous is not None and previous != os.path.realpath(tree):
+            os.utime(previous)
+        self.prune(os.path.realpath(tree))
+
+    def prune(self, current):
+        """
+        Remove the worktrees of the mirror retired for longer than the grace
+        period, requests of any worker may still read from the younger ones.
+        Failures are only logged, the new tree is live already.
+
+        Args:
+            current (os.path): real path of the checked out worktree
+        """
+        try:
+            out = subprocess.run([self.git, '-C', self.mirror, 'worktree', 'list', '--porcelain'],
+                                 check=True, capture_output=True, text=True).stdout
+            trees = [l[len('worktree '):] for l in out.splitlines() if l.startswith('worktree ')]
+            expired = time.time() - Meta.GRACE
+            for tree in trees:
+                real = os.path.realpath(tree)
+                if real in (current, os.path.realpath(self.mirror)) or \
+                        not os.path.isdir(real) or os.stat(real).st_mtime > expired:
+                    continue
+                subprocess.run([self.git, '-C', self.mirror, 'worktree', 'remove', '--force', tree], check=True)
+        except (OSError, subprocess.CalledProcessError):
+            APP.logger.exception('Pruning the meta worktrees failed')
+
+
+# (version, elections) of the last complete listing, see Election.all
+_elections = (None, [])
 
 
 class Election(Meta):
@@ -53,31 +216,113 @@ class Election(Meta):
     YML = 'election.yaml'
     VOT = 'voters.yaml'
 
-    def __init__(self, key):
+    def __init__(self, key, root=None):
         Meta.__init__(self, APP.config['META'])
-        self.store = os.path.join(self.META, self.ELECDIR)
-        self.path = os.path.join(self.store, key.replace('---','/'))
+        # resolve the META link once, the election is read from one snapshot
+        # even if the meta repository is updated meanwhile
+        root = root or os.path.realpath(self.META)
+        utils.snapshot(root)
+        self.store = os.path.join(root, self.ELECDIR)
+        self.path = os.path.join(self.store, key.replace('---', os.sep))
+        # every file of the election lives directly in its directory
+        self.prefix = self.path + os.sep
         self.key = key
         self.election = {}
 
-        if not os.path.exists(self.path):
+        try:
+            # list the election's files once, the lookups below check this
+            # instead of hitting the filesystem
+            with os.scandir(self.path) as it:
+                self.entries = {e.name: e for e in it}
+        except (FileNotFoundError, NotADirectoryError):
             F.abort(404)
-        else:
-            self.build()
+
+        self.build()
 
     @staticmethod
-    def all():
+    def all(keys=None, processes=None):
         """
         Get all elections in the repository
 
+        Args:
+            keys (set): only build the elections with these keys (optional)
+            processes (int): build the elections in a pool of processes, for
+                             the offline syncs only (optional)
+
         Returns:
             list: list of all the elections
         """
+        global _elections
         meta = Meta(APP.config['META'])
-        path = os.path.join(meta.META, meta.ELECDIR)
-        keys = Election.listelecdirs(path)
 
-        return [Election(k).get() for k in keys]
+        # the complete listing is reused until the meta repository changes
+        version = None
+        if keys is None and not processes and not APP.config['DEBUG']:
+            version = meta.version()
+        if version is not None and _elections[0] != version:
+            # parsed already by another worker, or before a restart
+            saved = meta.load()
+            if saved is not None:
+                _elections = (version, saved)
+        if version is not None and _elections[0] == version:
+            elections = _elections[1]
+            # the status moves with the clock, not with the repository
+            for e in elections:
+                e['status'] = election_status(e)
+            return list(elections)
+
+        # resolve the META link once (after reading the version, a swap
+        # meanwhile only makes the next call rebuild), the elections are all
+        # listed and built from the same snapshot
+        root = os.path.realpath(meta.META)
+        sha = None
+        if version is not None:
+            try:
+                sha = meta.head(root)
+            except subprocess.CalledProcessError:
+                pass
+
+        path = os.path.join(root, meta.ELECDIR)
+        elecdirs = Election.listelecdirs(path)
+        if keys is not None:
+            elecdirs = [k for k in elecdirs if k in keys]
+
+        if processes:
+            with ProcessPoolExecutor(processes) as pool:
+                return list(pool.map(functools.partial(build, root=root), elecdirs))
+
+        elections = [Election(k, root).get() for k in elecdirs]
+        if version is not None:
+            _elections = (version, elections)
+            if sha is not None:
+                meta.save(sha, elections)
+        return list(elections)
+
+    @staticmethod
+    def affected(paths):
+        """
+        Map the paths changed in the meta repository (relative to its root)
+        to the keys of the elections they belong to
+
+        Args:
+            paths (list): changed paths, as listed in a github push event
+
+        Returns:
+            set: keys of the affected elections
+        """
+        meta = Meta(APP.config['META'])
+        prefix = os.path.normpath(meta.ELECDIR or '.')
+        # elections at the root of the repository have no prefix
+        prefix = '' if prefix == '.' else prefix + '/'
+        keys = set()
+        for path in paths:
+            if not path.startswith(prefix):
+                continue
+            elecdir = os.path.dirname(path[len(prefix):])
+            if elecdir:
+                keys.add(elecdir.replace('/', '---'))
+
+        return keys
 
     @staticmethod
     def where(key, value):
@@ -86,54 +331,62 @@ class Election(Meta):
     @staticmethod
     def listelecdirs(path):
         """Return the set of election directories"""
-        elecdirs = []
+        elecdirs = set()
         for root, dirs, files in os.walk(path, topdown=True):
-           for name in dirs:
-               if os.path.exists(os.path.join(root, name, Election.YML)):
-                   """append each election directory to the list of directories
-                   and make nested dirs url-safe"""
-                   curdir = os.path.relpath(os.path.join(root, name),path)
-                   safedir = curdir.replace('/','---')
-                   elecdirs.append(safedir)
+            # os.walk already lists the files of every directory it visits
+            # (via scandir), so checking for the election.yaml there avoids a
+            # stat() per sub-directory
+            elections = [root] if root != path and Election.YML in files else []
+            # os.walk does not descend into symlinked directories, look
+            # through the links for their election.yaml
+            elections += [os.path.join(root, name) for name in dirs
+                          if os.path.islink(os.path.join(root, name))
+                          and os.path.exists(os.path.join(root, name, Election.YML))]
+            for elecdir in elections:
+                """append each election directory to the list of directories
+                and make nested dirs url-safe"""
+                curdir = os.path.relpath(elecdir, path)
+                safedir = curdir.replace(os.sep, '---')
+                elecdirs.add(safedir)
 
         return elecdirs
 
     def get(self):
-        if not os.path.exists(self.path) or not os.path.isdir(self.path):
-            return F.abort(404)
-        return self.build()
+        # the election is built once when the object is created
+        return self.election
 
     def build(self):
-        self.election = utils.parse_yaml(os.path.join(self.path, Election.YML))
+        self.election = utils.parse_yaml(self.prefix + Election.YML)
         self.election['status'] = self.status()
         self.election['key'] = self.key
         self.election['description'] = self.description()
         self.election['results'] = self.results()
 
-        if 'exception_due' not in self.election.keys():
+        if 'exception_due' not in self.election:
             self.election['exception_due'] = self.election['start_datetime']
         return self.election
 
     def status(self):
-        start = self.election['start_datetime']
-        end = self.election['end_datetime']
-        now = datetime.now()
-
-        if now < start:
-            return constants.ELEC_STAT_UPCOMING
-        elif end < now:
-            return constants.ELEC_STAT_COMPLETED
-        else:
-            return constants.ELEC_STAT_RUNNING
+        return election_status(self.election)
 
     def description(self):
-        return utils.parse_md(os.path.join(self.path, Election.DES))
+        if Election.DES not in self.entries:
+            return None
+        return utils.parse_md(self.prefix + Election.DES)
 
     def results(self):
-        return utils.parse_md(os.path.join(self.path, Election.RES))
+        if Election.RES not in self.entries:
+            return None
+        return utils.parse_md(self.prefix + Election.RES)
 
     def voters(self):
-        return utils.parse_yaml(os.path.join(self.path, Election.VOT))
+        return utils.parse_yaml(self.prefix + Election.VOT)
+
+    def eligible(self, username):
+        """Check if the user is in the election's eligible voters"""
+        if Election.VOT not in self.entries:
+            return False
+        return username in utils.cached(self.prefix + Election.VOT, utils.load_voters)
         
     def showfields(self):
         return dict.fromkeys(self.election['show_candidate_fields'], '')
@@ -142,16 +395,16 @@ class Election(Meta):
         """
         Build candidates and a list of candidates in random order
         """
-        files = [k for k in os.listdir(self.path) if k.startswith('candidate')]
+        files = [e for e in self.entries.values()
+                 if e.name.startswith('candidate') and e.is_file()]
         candidates = []
         for f in files:
-            md = open(os.path.join(self.path, f)).read()
             try:
-                c = utils.extract_candidate_info(md)
+                c = dict(utils.cached(f.path, utils.load_candidate)[0])
                 c['key'] = c['ID']
                 candidates.append(c)
             except:
-                raise Exception("Invalid candidate file : {}".format(f))
+                raise Exception("Invalid candidate file : {}".format(f.name))
 
         # As per the specifications the candidates must!! be in random order
         random.shuffle(candidates)
@@ -159,15 +412,14 @@ class Election(Meta):
         return candidates
 
     def candidate(self, cid):
-        path = os.path.join(self.path, 'candidate-{}.md'.format(cid))
-        if not os.path.exists(path) or not os.path.isfile(path):
+        entry = self.entries.get('candidate-{}.md'.format(cid))
+        if entry is None or not entry.is_file():
             return F.abort(404)
 
-        md = open(path).read()
-        candidate = utils.extract_candidate_info(md)
+        info, description = utils.cached(entry.path, utils.load_candidate)
+        candidate = dict(info)
         candidate['key'] = cid
-        candidate['description'] = utils.parse_md(
-            utils.extract_candidate_description(md), False)
+        candidate['description'] = utils.parse_md(description, False)
         # return only the candidate optional fields that are listed in show_candidate_fields
         # unfilled fields are returned as '' so the label still displays
         candidate['fields'] = self.showfields()
@@ -176,3 +428,119 @@ class Election(Meta):
             if field in candidate['fields']:
                 candidate['fields'][field] = info[field]
         return candidate
+
+
+def election_status(election):
+    start = election['start_datetime']
+    end = election['end_datetime']
+    now = datetime.now()
+
+    if now < start:
+        return constants.ELEC_STAT_UPCOMING
+    elif end < now:
+        return constants.ELEC_STAT_COMPLETED
+    else:
+        return constants.ELEC_STAT_RUNNING
+
+
+def build(key, root=None):
+    """
+    Build the election with the given key, module level so that it can be
+    handed to a worker process
+    """
+    return Election(key, root).get()
+
+
+class Refresher:
+    """
+    Refresher keeps the meta repository and the database in sync from a
+    single background thread. Syncs are queued by the webhook, and a timer
+    pulls every META['REFRESH'] seconds to catch up on missed webhooks.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the refresher thread of this process, once"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def submit(self, paths=None):
+        """
+        Queue a sync of the meta repository
+
+        Args:
+            paths (list): paths changed in the meta repository, everything is
+                          synced when not given
+        """
+        self.start()
+        self.queue.put(('push', paths))
+
+    def run(self):
+        # an interval of 0 (or less) disables the timer, only the webhook syncs
+        interval = APP.config['META']['REFRESH']
+        timeout = interval if interval > 0 else None
+        while True:
+            try:
+                job, paths = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                job, paths = 'timer', None
+
+            try:
+                self.refresh(job, paths)
+            except Exception:
+                APP.logger.exception('Syncing the meta repository failed')
+            finally:
+                SESSION.remove()
+
+    def refresh(self, job, paths):
+        backend = Meta(APP.config['META'])
+
+        # the workers of the application share the meta repository, only
+        # one of them may run git at a time
+        with open(backend.META + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            synced = self.synced(backend)
+            if not os.path.isdir(backend.META):
+                backend.clone()
+                paths = None
+            else:
+                # a push only lists its own changes, the ones of an earlier
+                # sync that did not complete need a full sync
+                if backend.head() != synced:
+                    paths = None
+                backend.pull()
+
+            # synced already, by this or another worker
+            head = backend.head()
+            if head == synced:
+                return
+
+            if paths is None:
+                log = utils.sync(SESSION, Election.all(), strict=True)
+            else:
+                keys = Election.affected(paths)
+                log = utils.sync(SESSION, Election.all(keys), keys, strict=True)
+
+            with open(backend.META + '.synced', 'w') as f:
+                f.write(head)
+
+        APP.logger.info(log)
+
+    @staticmethod
+    def synced(backend):
+        """Return the sha of the last commit synced with the database"""
+        try:
+            with open(backend.META + '.synced') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+
+refresher = Refresher()
@@ -15,17 +15,106 @@
 # Author(s):         Manish Sahani <rec.manish.sahani@gmail.com>
 
 import os
+import copy
+import functools
 import yaml
 import markdown2 as markdown
 
 from elekto import constants
 from elekto.models.sql import Election
 
-# to preserve the import consistency
+# to preserve the import consistency, prefer the libyaml backed safe loader
+# and fall back to the pure python one when PyYAML was built without libyaml
 try:
-    from yaml import CLoader as Loader
+    from yaml import CSafeLoader as Loader
 except ImportError:
-    from yaml import Loader
+    from yaml import SafeLoader as Loader
+
+# Parsed meta files, keyed on the file path. Every entry remembers the
+# (mtime, size) of the file it was built from so a `git pull` that rewrites
+# the file invalidates it on the next read.
+_parse_cache = {}
+_parse_root = None
+
+
+def snapshot(root):
+    """
+    Drop the cached files when the meta repository was checked out in a new
+    worktree, none of the old paths will be read again.
+
+    Args:
+        root (os.path): real path of the current meta checkout
+    """
+    global _parse_root
+    if root != _parse_root:
+        _parse_cache.clear()
+        _parse_root = root
+
+
+def cached(path, loader):
+    """
+    Return loader(path), reusing the previous result while the file is
+    unchanged on the disk
+
+    Args:
+        path (os.path): location of the file
+        loader (function): parses the file at the given path
+
+    Returns:
+        object: the (possibly cached) value returned by the loader
+
+    Raises:
+        FileNotFoundError: if the file does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _parse_cache.pop(path, None)
+        raise
+
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    hit = _parse_cache.get(path)
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+
+    value = loader(path)
+    _parse_cache[path] = (stamp, value)
+    return value
+
+
+def read(path):
+    """
+    Read a utf-8 encoded file in one go
+
+    Args:
+        path (os.path): location of the file
+
+    Returns:
+        string: content of the file
+    """
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def load_yaml(yaml_path):
+    # hand the raw bytes to the parser, libyaml decodes them itself instead
+    # of re-encoding a decoded python string
+    with open(yaml_path, 'rb') as f:
+        return yaml.load(f.read(), Loader=Loader)
+
+
+def load_voters(yaml_path):
+    """
+    Loads the eligible voters of a voters yaml file as a set, for the
+    membership checks of every election request
+
+    Args:
+        yaml_path (os.path): location of the voters yaml file
+
+    Returns:
+        frozenset: eligible voters
+    """
+    return frozenset(load_yaml(yaml_path)['eligible_voters'] or ())
 
 
 def parse_yaml(yaml_path):
@@ -38,11 +127,13 @@ def parse_yaml(yaml_path):
     Returns:
         dict: parsed yaml content in a dict
     """
-    if os.path.exists(yaml_path) is False:
+    try:
+        # callers add their own keys to the parsed dict, hand out a copy so
+        # the cached value stays pristine
+        return copy.copy(cached(yaml_path, load_yaml))
+    except FileNotFoundError:
         return None
 
-    return yaml.load(open(yaml_path, 'r').read(), Loader=Loader)
-
 
 def parse_yaml_from_string(yaml_string):
     """
@@ -57,47 +148,42 @@ def parse_yaml_from_string(yaml_string):
     return yaml.load(yaml_string, Loader=Loader)
 
 
-def extract_candidate_info(md):
+def parse_candidate(md):
     """
-    Extract candidates info from the given hybrid string
+    Split the hybrid string in the candidate's info and description with a
+    single scan for the delimiter
 
     Args:
         md (string): markdown string read from the candidate-xxxx.md file
 
     Returns:
-        dict: candidate info as a dict
+        tuple: candidate info as a dict and the markdown description
     """
     # TODO : check for wrong candidates strings
+    end = md.rfind(constants.CAND_END_DEL)
     info = md[md.find(
         constants.CAND_START_DEL) - 1 +
-        len(constants.CAND_START_DEL):md.rfind(constants.CAND_END_DEL)]
+        len(constants.CAND_START_DEL):end]
+    desc = md[end + len(constants.CAND_END_DEL):] if end != -1 else md
 
-    info = info.strip('-').strip('\n')
+    return (parse_yaml_from_string(info.strip('-').strip('\n')),
+            desc.strip('-').strip('\n'))
 
-    return parse_yaml_from_string(info)
 
+def load_candidate(path):
+    return parse_candidate(read(path))
 
-def extract_candidate_description(md):
-    """
-    Extract candidates description from the hybrid string
 
-    Args:
-        md (string): markdown string read from the candidate-xxxx.md file
-
-    Returns:
-        string: mardown description
-    """
-    desc = md.split(constants.CAND_END_DEL)[-1].strip('-').strip('\n')
-    return desc
-
-
-def sync(session, elections):
+def sync(session, elections, keys=None, strict=False):
     """
     Sync db with the meta - add and delete old elections
 
     Args:
         session (object): database session
         elections (dict): list of all the elections from the meta
+        keys (set): restrict the sync to these election keys, `elections`
+                    then only has to contain the ones still in the meta
+        strict (bool): raise the database errors instead of logging them
 
     Returns:
         string: returns a log
@@ -105,29 +191,40 @@ def sync(session, elections):
     meta_elections = {e['key']: e for e in elections}
     log = "---------------------*=  Syncing started =*----------------------\n\n"
 
-    # Delete election from the database that are not in the meta anymore
+    # Fetch the elections of the database in one query instead of one query
+    # per election of the meta
     try:
-        elections = session.query(Election).all()
-        for election in elections:
-            if election.key not in meta_elections.keys():
-                log += " - Deleted {} from the database.\n".format(election.key)
-                session.delete(election)
+        query = session.query(Election)
+        if keys is not None:
+            query = query.filter(Election.key.in_(keys))
+        db_elections = {e.key: e for e in query.all()}
     except:
+        if strict:
+            raise
         log += " x Error while querying to the database.\n"
+        db_elections = None
+
+    if db_elections is not None:
+        # Delete election from the database that are not in the meta anymore
+        for key, election in db_elections.items():
+            if key not in meta_elections:
+                log += " - Deleted {} from the database.\n".format(key)
+                session.delete(election)
 
-    # Add the new added elections from the meta in the database.
-    for e in meta_elections.keys():
-        try:
-            q = session.query(Election).filter_by(key=e).first()
-            if q:
-                q.name = meta_elections[e]['name']
-            else:
-                session.add(Election(key=e, name=meta_elections[e]['name']))
-                # Add the entry to the log
-                log += " + {} added in the database.\n".format(meta_elections[e]['name'])
-        except:
-            # Add error to the log
-            log += " x while adding {} in the database, application ran in to error.\n"
+        # Add the new added elections from the meta in the database.
+        added = []
+        for key, e in meta_elections.items():
+            try:
+                if key in db_elections:
+                    db_elections[key].name = e['name']
+                else:
+                    added.append(Election(key=key, name=e['name']))
+                    # Add the entry to the log
+                    log += " + {} added in the database.\n".format(e['name'])
+            except:
+                # Add error to the log
+                log += " x while adding {} in the database, application ran in to error.\n".format(key)
+        session.add_all(added)
 
     log += "\n\n---------------------*= Syncing completed *=--------------------"
     session.commit()
@@ -140,9 +237,22 @@ def parse_md(md, path=True):
     """
     try:
         if path:
-            md = open(md, 'r').read()
-        return markdown.markdown(md, extras=['cuddled-lists'])
+            return cached(md, load_md)
+        return render(md)
     except FileNotFoundError:
         return None
     except:
         return 'Markdown format not Correct'
+
+
+def load_md(md_path):
+    return render(read(md_path))
+
+
+@functools.lru_cache(maxsize=256)
+def render(md):
+    """
+    Render the markdown string to html, candidate descriptions are rendered
+    on every request so the result is memoized on the string itself.
+    """
+    return markdown.markdown(md, extras=['cuddled-lists'])
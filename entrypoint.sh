@@ -15,10 +15,10 @@ else
   if [ $APP_CONNECT == "socket" ]; then
     # socket mode for fronting by nginx
     echo "with a socket connection on $APP_PORT"
-    uwsgi --module elekto:APP --processes 8 --socket :$APP_PORT
+    uwsgi --module elekto:APP --processes 8 --enable-threads --socket :$APP_PORT
   else
     # http mode for direct connection
     echo "with an http connection on $APP_PORT"
-    uwsgi --module elekto:APP --processes 8 --http :$APP_PORT
+    uwsgi --module elekto:APP --processes 8 --enable-threads --http :$APP_PORT
   fi
 fi
@@ -0,0 +1,161 @@
+# Copyright 2020 The Elekto Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+# Workaround to safely import the elekto module
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+os.environ.setdefault('DB_CONNECTION', 'sqlite')
+
+from elekto.models.meta import Election  # noqa
+
+# ############################################################################
+# suite: meta
+# description: Testing of the meta repository helpers
+# ############################################################################
+
+
+def test_listelecdirs(tmp_path):
+    """
+    Tests that nested and symlinked election directories are listed
+    """
+    for d in ('e1', 'group/e2', 'group/notes', 'outside/e3'):
+        os.makedirs(tmp_path / d)
+    for d in ('e1', 'group/e2', 'outside/e3'):
+        (tmp_path / d / Election.YML).write_text('name: x\n')
+    elections = tmp_path / 'elections'
+    os.makedirs(elections)
+    os.rename(tmp_path / 'e1', elections / 'e1')
+    os.rename(tmp_path / 'group', elections / 'group')
+    os.symlink(tmp_path / 'outside' / 'e3', elections / 'e3')
+
+    assert Election.listelecdirs(str(elections)) == {'e1', 'group---e2', 'e3'}
+
+
+def test_affected(monkeypatch):
+    """
+    Tests the mapping of the paths changed by a push to election keys
+    """
+    from elekto import APP
+
+    monkeypatch.setitem(APP.config['META'], 'ELECDIR', './elections/')
+    keys = Election.affected([
+        'elections/e1/election.yaml',
+        'elections/group/e2/candidate-jane.md',
+        'elections/README.md',
+        'docs/elections/e4/election.yaml',
+    ])
+
+    assert keys == {'e1', 'group---e2'}
+
+    # elections at the root of the repository
+    for elecdir in ('.', ''):
+        monkeypatch.setitem(APP.config['META'], 'ELECDIR', elecdir)
+        assert Election.affected(['e1/election.yaml', 'README.md']) == {'e1'}
+
+
+def test_changed_paths():
+    """
+    Tests which push events can be synced incrementally
+    """
+    from elekto.controllers.webhook import changed_paths
+
+    push = {
+        'ref': 'refs/heads/main',
+        'forced': False,
+        'commits': [
+            {'added': ['elections/e1/voters.yaml'], 'modified': [], 'removed': []},
+            {'added': [], 'modified': ['elections/e2/election.yaml'],
+             'removed': ['elections/e3/election.yaml']},
+        ],
+    }
+    assert changed_paths(push, 'main') == ['elections/e1/voters.yaml',
+                                           'elections/e2/election.yaml',
+                                           'elections/e3/election.yaml']
+
+    # everything else needs a full sync
+    assert changed_paths(dict(push, forced=True), 'main') is None
+    assert changed_paths(dict(push, ref='refs/heads/dev'), 'main') is None
+    assert changed_paths(dict(push, commits=[]), 'main') is None
+    assert changed_paths(dict(push, commits=push['commits'] * 10), 'main') is None
+    assert changed_paths({'zen': 'ping'}, 'main') is None
+    assert changed_paths(None, 'main') is None
+
+
+def test_saved_elections(tmp_path, monkeypatch):
+    """
+    Tests that saved elections are only loaded for the same commit,
+    elections directory and format
+    """
+    from elekto.models.meta import Meta
+
+    config = {'PATH': str(tmp_path / 'meta'), 'ELECDIR': 'elections',
+              'REMOTE': None, 'BRANCH': 'main', 'SECRET': None}
+    monkeypatch.setattr(Meta, 'head', lambda self, path=None: 'abc')
+    Meta(config).save('abc', [{'key': 'e1'}])
+
+    assert Meta(config).load() == [{'key': 'e1'}]
+    assert os.listdir(tmp_path) == ['meta.cache.pickle']
+    assert Meta(dict(config, ELECDIR='other')).load() is None
+    monkeypatch.setattr(Meta, 'CACHE_FORMAT', Meta.CACHE_FORMAT + 1)
+    assert Meta(config).load() is None
+    monkeypatch.undo()
+    monkeypatch.setattr(Meta, 'head', lambda self, path=None: 'def')
+    assert Meta(config).load() is None
+
+
+def test_refresher_catches_up(tmp_path, monkeypatch):
+    """
+    Tests that a failed sync is retried in full by the next timer tick
+    """
+    from elekto import APP
+    from elekto.models import meta
+
+    monkeypatch.setitem(APP.config['META'], 'PATH', str(tmp_path / 'meta'))
+    monkeypatch.setitem(APP.config['META'], 'ELECDIR', 'elections')
+    os.makedirs(tmp_path / 'meta')
+    heads = iter(['old', 'new', 'new', 'new', 'new', 'new'])
+    monkeypatch.setattr(meta.Meta, 'head', lambda self, path=None: next(heads))
+    monkeypatch.setattr(meta.Meta, 'pull', lambda self: True)
+    monkeypatch.setattr(meta.Election, 'all', staticmethod(lambda keys=None: []))
+    (tmp_path / 'meta.synced').write_text('old')
+
+    calls = []
+
+    def sync(session, elections, keys=None, strict=False):
+        calls.append(keys)
+        if len(calls) == 1:
+            raise RuntimeError('database is gone')
+        return ''
+    monkeypatch.setattr(meta.utils, 'sync', sync)
+
+    refresher = meta.Refresher()
+    # the push pulls 'new' but the sync fails
+    try:
+        refresher.refresh('push', ['elections/e1/election.yaml'])
+    except RuntimeError:
+        pass
+    assert (tmp_path / 'meta.synced').read_text() == 'old'
+
+    # the timer finds the repository ahead of the database and syncs it all
+    refresher.refresh('timer', None)
+    assert calls == [{'e1'}, None]
+    assert (tmp_path / 'meta.synced').read_text() == 'new'
+
+    # and does nothing once they match
+    refresher.refresh('timer', None)
+    assert len(calls) == 2
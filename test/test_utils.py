@@ -0,0 +1,112 @@
+# Copyright 2020 The Elekto Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import pytest
+
+# Workaround to safely import the elekto module
+currentdir = os.path.dirname(os.path.realpath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.append(parentdir)
+os.environ.setdefault('DB_CONNECTION', 'sqlite')
+
+from elekto.models import utils  # noqa
+from elekto.models.sql import Election, migrate  # noqa
+
+# ############################################################################
+# suite: utils
+# description: Testing of the meta and database helpers
+# ############################################################################
+
+
+@pytest.fixture
+def session(tmp_path):
+    session = migrate('sqlite:///{}'.format(tmp_path / 'test.db'))
+    yield session
+    session.remove()
+
+
+def rows(session):
+    return {e.key: e.name for e in session.query(Election).all()}
+
+
+def test_sync(session):
+    """
+    Tests that a full sync adds, renames and deletes the elections
+    """
+    utils.sync(session, [{'key': 'e1', 'name': 'One'},
+                         {'key': 'e2', 'name': 'Two'}])
+    assert rows(session) == {'e1': 'One', 'e2': 'Two'}
+
+    log = utils.sync(session, [{'key': 'e1', 'name': 'First'},
+                               {'key': 'e3', 'name': 'Three'}])
+    assert rows(session) == {'e1': 'First', 'e3': 'Three'}
+    assert 'Deleted e2' in log
+    assert 'Three added' in log
+
+
+def test_sync_keys(session):
+    """
+    Tests that a keyed sync only touches the given elections
+    """
+    utils.sync(session, [{'key': 'e1', 'name': 'One'},
+                         {'key': 'e2', 'name': 'Two'},
+                         {'key': 'e3', 'name': 'Three'}])
+
+    # e1 renamed, e2 removed from the meta, e4 added, e3 not part of the push
+    utils.sync(session, [{'key': 'e1', 'name': 'First'},
+                         {'key': 'e4', 'name': 'Four'}],
+               {'e1', 'e2', 'e4'})
+
+    assert rows(session) == {'e1': 'First', 'e3': 'Three', 'e4': 'Four'}
+
+
+def test_load_voters(tmp_path):
+    """
+    Tests the cached eligible voters set of a voters file
+    """
+    path = str(tmp_path / 'voters.yaml')
+    with open(path, 'w') as f:
+        f.write('base: &voters\n  - alice\n  - 12345\n  - "67890"\n'
+                'eligible_voters: *voters\n')
+
+    voters = utils.cached(path, utils.load_voters)
+    # the typed yaml values are kept, the alias is followed
+    assert 'alice' in voters
+    assert '67890' in voters
+    assert '12345' not in voters
+    assert 'base' not in voters
+    assert utils.cached(path, utils.load_voters) is voters
+
+    with open(path, 'w') as f:
+        f.write('eligible_voters:\n  - alice\n  - bob\n')
+    os.utime(path, ns=(0, 0))
+
+    assert utils.cached(path, utils.load_voters) == {'alice', 'bob'}
+
+
+def test_sync_invalid_election(session):
+    """
+    Tests that a malformed election is logged and skipped
+    """
+    utils.sync(session, [{'key': 'e1', 'name': 'One'}])
+
+    log = utils.sync(session, [{'key': 'e1'},
+                               {'key': 'e2', 'name': 'Two'},
+                               {'key': 'e3'}])
+
+    assert rows(session) == {'e1': 'One', 'e2': 'Two'}
+    assert 'while adding e1' in log
+    assert 'while adding e3' in log